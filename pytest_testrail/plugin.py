@@ -1,14 +1,20 @@
 """Reference: http://docs.gurock.com/testrail-api2/reference-statuses"""
 import re
-import textwrap
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dataclasses import dataclass
 from datetime import datetime
-from queue import Queue
-from threading import Thread
-from typing import List, Dict, Any
+from functools import cached_property, lru_cache
+from operator import itemgetter
+from typing import List, Dict, Any, Optional
 
 import pytest
 
+TEST_ID_REGEX = re.compile(r'(?P<test_id>[0-9]+)$')
+RESULTS_ORDER = itemgetter('case_id', 'status_id')
+# Parts of TestRail errors naming a testcase, i.e. 'Field :results.case_id is not a valid test case.'
+CASE_ERRORS = ('case_id', 'test case', 'run/case')
+
 
 @dataclass
 class URL:
@@ -40,7 +46,9 @@ class PyTestRailPlugin:
     tr_prefix: str = 'testrail'
     time_format: str = '%d-%m-%Y %H:%M:%S'
     max_comment_size: int = 4000
-    max_concurrent_requests: int = 60
+    max_concurrent_requests: int = 8
+    max_results_per_request: int = 1000
+    ids_per_line: int = 15
 
     def __init__(self, client, assign_user_id, project_id, suite_id, include_all, cert_check, tr_name, run_id=0,
                  plan_id=0, version='', close_on_complete=False, publish_blocked=True, skip_missing=False):
@@ -58,6 +66,8 @@ class PyTestRailPlugin:
         self.close_on_complete: bool = close_on_complete
         self.publish_blocked: bool = publish_blocked
         self.skip_missing: bool = skip_missing
+        self._testplans: Dict[int, Dict[str, Any]] = {}
+        self._testrail_ids: Dict[str, List[int]] = {}
 
     # pytest hooks
     def pytest_report_header(self, config, startdir):
@@ -75,16 +85,18 @@ class PyTestRailPlugin:
     def pytest_collection_modifyitems(self, session, config, items):
         items_with_tr_keys = self.get_testrail_keys(items)
         tr_keys = [case_id for item in items_with_tr_keys for case_id in item[1]]
+        # Remember testcase ids of marked items, so their reports don't have to look up markers again.
+        self._testrail_ids = {item.nodeid: case_ids for item, case_ids in items_with_tr_keys}
 
         if self.testplan_id and self.is_testplan_available:
             self.testrun_id = 0
         elif self.testrun_id and self.is_testrun_available:
             self.testplan_id = 0
             if self.skip_missing:
-                tests_list = [test.get('case_id') for test in self.get_tests(self.testrun_id)]
+                tests_set = {test.get('case_id') for test in self.get_tests(self.testrun_id)}
+                mark = pytest.mark.skip('Test is not present in testrun.')
                 for item, case_id in items_with_tr_keys:
-                    if not set(case_id).intersection(set(tests_list)):
-                        mark = pytest.mark.skip('Test is not present in testrun.')
+                    if tests_set.isdisjoint(case_id):
                         item.add_marker(mark)
         else:
             if self.testrun_name is None:
@@ -103,57 +115,70 @@ class PyTestRailPlugin:
         """Return list of Pytest nodes and TestRail ids from pytest markers."""
         test_case_ids = []
         for item in items:
-            if item.get_closest_marker(self.tr_prefix):
-                test_case_ids.append(
-                    (item, self.clean_test_ids(
-                        item.get_closest_marker(self.tr_prefix).kwargs.get('ids'))
-                     )
-                )
+            marker = item.get_closest_marker(self.tr_prefix)
+            if marker:
+                test_case_ids.append((item, self.clean_test_ids(marker.kwargs.get('ids'))))
         return test_case_ids
 
     @staticmethod
     def clean_test_ids(test_ids: List) -> List[int]:
         """Clean pytest marker containing testrail testcase ids."""
-        return [int(re.search('(?P<test_id>[0-9]+$)', test_id).groupdict().get('test_id')) for test_id in test_ids]
+        return [PyTestRailPlugin.clean_test_id(test_id) for test_id in test_ids]
+
+    @staticmethod
+    @lru_cache(maxsize=None)
+    def clean_test_id(test_id: str) -> int:
+        """Clean a testrail testcase id, i.e. 'C123' -> 123."""
+        return int(TEST_ID_REGEX.search(test_id).group('test_id'))
 
     @pytest.hookimpl(tryfirst=True, hookwrapper=True)
     def pytest_runtest_makereport(self, item, call):
         """Collect result and associated testcases (TestRail) of an execution."""
         outcome = yield
         rep = outcome.get_result()
-        if item.get_closest_marker(self.tr_prefix):
-            test_case_ids = item.get_closest_marker(self.tr_prefix).kwargs.get('ids')
-
-            if rep.when == 'call' and test_case_ids:
-                self.add_result(
-                    self.clean_test_ids(test_case_ids),
-                    {"passed": 1, "failed": 5, "skipped": 2}.get(outcome.get_result().outcome),
-                    comment=rep.longrepr,
-                    duration=rep.duration
-                )
+        if rep.when != 'call':
+            return
+        test_case_ids = self._testrail_ids.get(item.nodeid)
+        if test_case_ids is None:  # Item not marked at collection, a marker may have been added since
+            marker = item.get_closest_marker(self.tr_prefix)
+            test_case_ids = self.clean_test_ids(marker.kwargs.get('ids')) if marker else []
+        if test_case_ids:
+            self.add_result(
+                test_case_ids,
+                {"passed": 1, "failed": 5, "skipped": 2}.get(rep.outcome),
+                # Keep a bounded string rather than the report objects for the whole session.
+                comment=str(rep.longrepr)[-self.max_comment_size * 2:] if rep.longrepr else '',
+                duration=rep.duration
+            )
 
     def pytest_sessionfinish(self, session, exitstatus):
         """Publish results in TestRail."""
         print(f'\n\n[{self.tr_prefix}] Start publishing')
-        if self.results:
-            tests_list = [str(result['case_id']) for result in self.results]
-            print(f'[{self.tr_prefix}] Testcases to publish:')
-            print(textwrap.fill(f', '.join(tests_list), 110))
-
-            if self.testrun_id:
-                self.publish_results(self.testrun_id)
-            elif self.testplan_id:
-                testruns = self.get_available_testruns(self.testplan_id)
-                print(f'[{self.tr_prefix}] Testruns to update: {", ".join([str(elt) for elt in testruns])}')
-                for testrun_id in testruns:
-                    self.publish_results(testrun_id)
-            else:
-                print(f'[{self.tr_prefix}] No data published')
-
-            if self.close_on_complete and self.testrun_id:
-                self.close_test_run(self.testrun_id)
-            elif self.close_on_complete and self.testplan_id:
-                self.close_test_plan(self.testplan_id)
+        try:
+            if self.results:
+                # Results of a same testcase are ordered by status id, TestRail keeps the last published one.
+                self.results.sort(key=RESULTS_ORDER)
+                print(f'[{self.tr_prefix}] Testcases to publish:')
+                case_ids = [str(result['case_id']) for result in self.results]
+                for start in range(0, len(case_ids), self.ids_per_line):
+                    print(', '.join(case_ids[start:start + self.ids_per_line]))
+
+                if self.testrun_id:
+                    self.publish_results(self.testrun_id)
+                elif self.testplan_id:
+                    testruns = self.get_available_testruns(self.testplan_id)
+                    print(f'[{self.tr_prefix}] Testruns to update: {", ".join(map(str, testruns))}')
+                    for testrun_id in testruns:
+                        self.publish_results(testrun_id)
+                else:
+                    print(f'[{self.tr_prefix}] No data published')
+
+                if self.close_on_complete and self.testrun_id:
+                    self.close_test_run(self.testrun_id)
+                elif self.close_on_complete and self.testplan_id:
+                    self.close_test_plan(self.testplan_id)
+        finally:
+            self.client.close()
         print(f'[{self.tr_prefix}] End publishing')
 
     # plugin
@@ -176,33 +201,65 @@ class PyTestRailPlugin:
             self.results.append(data)
 
     def publish_results(self, testrun_id: int):
-        """Add results one by one to improve errors handling."""
-        results = (self.__process_result(result) for result in self.results)
-        if not self.publish_blocked:  # Manage case of "blocked" testcases.
+        """Add results in batches, falling back to one by one for rejected batches to improve errors handling."""
+        # A batch is rejected as a whole if one of its testcases is not in the testrun (i.e. testruns of a testplan
+        # holding a subset of the testcases), so only testcases of the testrun are published.
+        try:
+            tests = self.get_tests(testrun_id)
+        except TestsNotFoundException:
+            print(f'[{self.tr_prefix}] Testcases of testrun #{testrun_id} unknown, publishing all results')
+            tests = None
+        results = self.results
+        if tests is not None:
+            run_tests = {test.get('case_id') for test in tests}
+            results = [r for r in results if r.get('case_id') in run_tests]
+        if not self.publish_blocked and tests is not None:  # Manage case of "blocked" testcases.
             print(f'[{self.tr_prefix}] Option "Don\'t publish blocked testcases" activated')
-            blocked_tests_list = [test.get('case_id') for test in self.get_tests(testrun_id)
-                                  if test.get('status_id') == self.test_status["blocked"]]
-            print(f'[{self.tr_prefix}] Blocked testcases excluded: {", ".join(str(elt) for elt in blocked_tests_list)}')
-            results = (self.__process_result(r) for r in self.results if r.get('case_id') not in blocked_tests_list)
+            blocked_tests = {test.get('case_id') for test in tests
+                             if test.get('status_id') == self.test_status["blocked"]}
+            print(f'[{self.tr_prefix}] Blocked testcases excluded: {", ".join(map(str, sorted(blocked_tests)))}')
+            results = [r for r in results if r.get('case_id') not in blocked_tests]
         if self.include_all:  # Prompt enabling include all test cases from test suite when creating test run.
             print(f'[{self.tr_prefix}] Option "Include all testcases from test suite for test run" activated')
 
-        queue = Queue(self.max_concurrent_requests * 2)
+        results = [self.__process_result(r) for r in results]
 
-        def do_work():
-            while True:
-                r = queue.get()
-                self.publish_result(r, testrun_id)
-                queue.task_done()
+        for start in range(0, len(results), self.max_results_per_request):
+            self.publish_batch(results[start:start + self.max_results_per_request], testrun_id)
 
-        for _ in range(self.max_concurrent_requests):
-            thread = Thread(target=do_work)
-            thread.daemon = True
-            thread.start()
+    def publish_batch(self, results: List[Dict[str, Any]], testrun_id: int):
+        response = self.client.send_post(
+            URL.add_results.format(testrun_id),
+            {'results': results},
+            cert_check=self.cert_check
+        )
+        error = self.client.get_error(response)
+        if error:
+            if any(reason in error for reason in CASE_ERRORS):  # A testcase of the batch is rejected
+                print(f'[{self.tr_prefix}] Info: Batch of testcases rejected for following reason: "{error}", '
+                      f'publishing one by one')
+                self.publish_results_one_by_one(results, testrun_id)
+            else:
+                print(f'[{self.tr_prefix}] Info: Testcases not published for following reason: "{error}"')
+
+    def publish_results_one_by_one(self, results: List[Dict[str, Any]], testrun_id: int):
+        """Publish results concurrently, keeping results of a same testcase in order (the last one wins)."""
+        results_by_case = defaultdict(list)
+        for result in results:
+            results_by_case[result['case_id']].append(result)
 
-        for r in results:
-            queue.put(r)
-            queue.join()
+        url_prefix = self.add_result_url_prefix(testrun_id)
+
+        def publish_case_results(case_id, case_results):
+            uri = url_prefix + str(case_id)
+            for r in case_results:
+                self.publish_result(r, testrun_id, uri=uri)
+
+        with ThreadPoolExecutor(max_workers=self.max_concurrent_requests) as executor:
+            futures = [executor.submit(publish_case_results, case_id, case_results)
+                       for case_id, case_results in results_by_case.items()]
+            for future in as_completed(futures):
+                future.result()
 
     def __process_result(self, result: Dict[str, Any]) -> Dict[str, Any]:
         entry = {'status_id': result['status_id'], 'case_id': result['case_id']}
@@ -219,15 +276,23 @@ class PyTestRailPlugin:
 
     def __formatted_comment(self, comment: str) -> str:
         # Indent text to avoid string formatting by TestRail. Limit size of comment.
-        _payload = str(comment)
-        _comment = '# Pytest result: #\n'
-        _comment += 'Log truncated\n...\n' if len(_payload) > self.max_comment_size else u''
-        _comment += '    ' + _payload[-self.max_comment_size:].replace('\n', '\n    ')
-        return _comment
+        payload = comment if isinstance(comment, str) else str(comment)
+        header = '# Pytest result: #\n'
+        if len(payload) > self.max_comment_size:
+            header += 'Log truncated\n...\n'
+            payload = payload[-self.max_comment_size:]
+        return header + '    ' + payload.replace('\n', '\n    ')
 
-    def publish_result(self, result: Dict[str, Any], testrun_id: int):
+    @staticmethod
+    def add_result_url_prefix(testrun_id: int) -> str:
+        """Return the add_result_for_case URL of a testrun, to be completed with a testcase id."""
+        return f'{URL.add_result}/{testrun_id}/'
+
+    def publish_result(self, result: Dict[str, Any], testrun_id: int, uri: Optional[str] = None):
+        if uri is None:
+            uri = self.add_result_url_prefix(testrun_id) + str(result['case_id'])
         response = self.client.send_post(
-            f'{URL.add_result}/{testrun_id}/{result.get("case_id")}',
+            uri,
             result,
             cert_check=self.cert_check
         )
@@ -270,21 +335,22 @@ class PyTestRailPlugin:
         if error:
             print(f'[{self.tr_prefix}] Failed to close test plan: "{error}"')
         else:
+            self._testplans.pop(testplan_id, None)
             print(f'[{self.tr_prefix}] Test plan with ID={self.testplan_id} was closed')
 
-    @property
+    @cached_property
     def is_testrun_available(self) -> bool:
-        """Ask if testrun is available in TestRail."""
+        """Ask if testrun is available in TestRail (asked once per plugin instance)."""
         response = self.client.send_get(URL.get_testrun.format(self.testrun_id), cert_check=self.cert_check)
         error = self.client.get_error(response)
         if error:
             return False
         return response['is_completed'] is False
 
-    @property
+    @cached_property
     def is_testplan_available(self) -> bool:
-        """Ask if testplan is available in TestRail."""
-        response = self.client.send_get(URL.get_testplan.format(self.testplan_id), cert_check=self.cert_check)
+        """Ask if testplan is available in TestRail (asked once per plugin instance)."""
+        response = self.get_testplan(self.testplan_id)
         error = self.client.get_error(response)
         if error:
             print(f'[{self.tr_prefix}] Failed to retrieve testplan: "{error}"')
@@ -294,7 +360,7 @@ class PyTestRailPlugin:
     def get_available_testruns(self, plan_id: int) -> List[int]:
         """Get a list of available testruns associated to a testplan in TestRail."""
         testruns_list = []
-        response = self.client.send_get(URL.get_testplan.format(plan_id), cert_check=self.cert_check)
+        response = self.get_testplan(plan_id)
         error = self.client.get_error(response)
         if error:
             print(f'[{self.tr_prefix}] Failed to retrieve testplan: "{error}"')
@@ -305,6 +371,15 @@ class PyTestRailPlugin:
                         testruns_list.append(run['id'])
         return testruns_list
 
+    def get_testplan(self, plan_id: int) -> Dict[str, Any]:
+        """Get a testplan from TestRail, successful responses are fetched once per plugin instance."""
+        if plan_id in self._testplans:
+            return self._testplans[plan_id]
+        response = self.client.send_get(URL.get_testplan.format(plan_id), cert_check=self.cert_check)
+        if not self.client.get_error(response):
+            self._testplans[plan_id] = response
+        return response
+
     def get_tests(self, run_id: int) -> List[Dict[str, Any]]:
         response = self.client.send_get(URL.get_tests.format(run_id), cert_check=self.cert_check)
         error = self.client.get_error(response)
@@ -15,7 +15,9 @@ import sys
 import requests
 import time
 
+from requests.adapters import HTTPAdapter
 from urllib.parse import urljoin
+from urllib3.util.retry import Retry
 
 
 class APIClient:
@@ -38,6 +40,9 @@ class APIClient:
         :param timeout: (optional) How many seconds to wait for the server to send data before giving up, as a float,
             or a :ref:`(connect timeout, read timeout) <timeouts>` tuple.
         :type timeout: float or tuple
+        :param pool_maxsize: (optional) Maximum number of connections kept alive to the TestRail server.
+            Defaults to ``16``.
+        :type pool_maxsize: int
         """
         self.user = user
         self.password = password
@@ -45,6 +50,20 @@ class APIClient:
         self.headers = kwargs.get('headers', {'Content-Type': 'application/json'})
         self.cert_check = kwargs.get('cert_check', True)
         self.timeout = kwargs.get('timeout', 10.0)
+        # Reuse connections across requests (keep-alive) instead of paying a TCP/TLS handshake per call.
+        # Idempotent requests are retried on transient server errors, 429 is handled below with Retry-After.
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=kwargs.get('pool_maxsize', 16),
+            max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=(500, 502, 503, 504),
+                              raise_on_status=False)
+        )
+        # The session is shared by the threads publishing results. requests doesn't guarantee Session to be
+        # thread-safe: this relies on every request passing its own auth/headers and on TestRail not setting
+        # cookies, so the only shared state is the connection pool, which urllib3 keeps thread-safe.
+        self._session = requests.Session()
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
 
     def send_get(self, uri, **kwargs):
         """
@@ -67,7 +86,7 @@ class APIClient:
         headers = kwargs.get('headers', self.headers)
         timeout = kwargs.get('timeout', self.timeout)
         url = self._url + uri
-        r = requests.get(
+        r = self._session.get(
             url,
             auth=(self.user, self.password),
             headers=headers,
@@ -106,7 +125,7 @@ class APIClient:
         headers = kwargs.get('headers', self.headers)
         timeout = kwargs.get('timeout', self.timeout)
         url = self._url + uri
-        r = requests.post(
+        r = self._session.post(
             url,
             auth=(self.user, self.password),
             headers=headers,
@@ -123,6 +142,12 @@ class APIClient:
         else:
             return r.json()
 
+    def close(self):
+        """
+        Close connections kept alive to the TestRail server.
+        """
+        self._session.close()
+
     @staticmethod
     def get_error(json_response):
         """ Extract error contained in a API response.
@@ -18,6 +18,7 @@ setup(
         'pytest_testrail',
     ],
     package_dir={'pytest_testrail': 'pytest_testrail'},
+    python_requires='>=3.8',
     install_requires=[
         'pytest>=3.6',
         'requests>=2.20.0',
@@ -3,20 +3,21 @@ from datetime import datetime
 from freezegun import freeze_time
 from mock import call, create_autospec
 import pytest
+import requests
 
-from pytest_testrail import plugin
-from pytest_testrail.plugin import PyTestRailPlugin, TESTRAIL_TEST_STATUS
+from pytest_testrail.plugin import PyTestRailPlugin, URL, pytestrail
 from pytest_testrail.testrail_api import APIClient
 
 
 pytest_plugins = "pytester"
 
 ASSIGN_USER_ID = 3
+TESTRAIL_TEST_STATUS = PyTestRailPlugin.test_status
 FAKE_NOW = datetime(2015, 1, 31, 19, 5, 42)
 PROJECT_ID = 4
 PYTEST_FILE = """
-    from pytest_testrail.plugin import testrail, pytestrail
-    @testrail('C1234', 'C5678')
+    from pytest_testrail.plugin import pytestrail
+    @pytestrail.case('C1234', 'C5678')
     def test_func():
         pass
     @pytestrail.case('C8765', 'C4321')
@@ -55,6 +56,16 @@ TESTPLAN = {
 }
 
 
+def run_tests(*case_ids):
+    """Fake response of `get_tests` for a testrun holding given testcases."""
+    return [{'case_id': case_id, 'status_id': TESTRAIL_TEST_STATUS["untested"]} for case_id in case_ids]
+
+
+def send_get_by_uri(responses):
+    """Fake `send_get` answering with the response registered for the requested uri."""
+    return lambda uri, **kwargs: responses[uri]
+
+
 @pytest.fixture
 def api_client():
     spec = create_autospec(APIClient)
@@ -138,6 +149,67 @@ def test_pytest_runtest_makereport(pytest_test_items, tr_plugin, testdir):
     assert tr_plugin.results == expected_results
 
 
+def test_pytest_runtest_makereport_bounded_comment(pytest_test_items, tr_plugin):
+    """ Failure representations are stored as strings bounded to twice the comment size """
+    class LongRepr:
+        def __str__(self):
+            return 'a' * 100 + 'b' * 20
+
+    class Report:
+        when = 'call'
+        outcome = 'failed'
+        longrepr = LongRepr()
+        duration = 2
+
+    class Outcome:
+        def get_result(self):
+            return Report()
+
+    tr_plugin.max_comment_size = 10
+    f = tr_plugin.pytest_runtest_makereport(pytest_test_items[0], None)
+    f.send(None)
+    with pytest.raises(StopIteration):
+        f.send(Outcome())
+
+    assert [result['comment'] for result in tr_plugin.results] == ['b' * 20, 'b' * 20]
+
+
+def test_pytest_runtest_makereport_collected_ids(testdir, tr_plugin, monkeypatch):
+    """ Testcase ids resolved at collection are reused, markers added afterwards are honored """
+    class Report:
+        when = 'call'
+        outcome = 'passed'
+        longrepr = None
+        duration = 1
+
+    class Outcome:
+        def get_result(self):
+            return Report()
+
+    def makereport(item):
+        f = tr_plugin.pytest_runtest_makereport(item, None)
+        f.send(None)
+        with pytest.raises(StopIteration):
+            f.send(Outcome())
+
+    marked_item, unmarked_item = testdir.getitems("""
+        from pytest_testrail.plugin import pytestrail
+        @pytestrail.case('C1234', 'C5678')
+        def test_marked():
+            pass
+        def test_unmarked():
+            pass
+    """)
+    tr_plugin.pytest_collection_modifyitems(None, None, [marked_item, unmarked_item])
+
+    monkeypatch.setattr(marked_item, 'get_closest_marker', lambda name: None)
+    makereport(marked_item)
+    unmarked_item.add_marker(pytestrail.case('C42'))
+    makereport(unmarked_item)
+
+    assert [result['case_id'] for result in tr_plugin.results] == [1234, 5678, 42]
+
+
 def test_pytest_sessionfinish(api_client, tr_plugin):
     tr_plugin.results = [
         {'case_id': 1234, 'status_id': TESTRAIL_TEST_STATUS["failed"], 'duration': 2.6},
@@ -145,6 +217,7 @@ def test_pytest_sessionfinish(api_client, tr_plugin):
         {'case_id': 1234, 'status_id': TESTRAIL_TEST_STATUS["passed"], 'duration': 2.6}
     ]
     tr_plugin.testrun_id = 10
+    api_client.send_get.return_value = run_tests(1234, 5678)
 
     tr_plugin.pytest_sessionfinish(None, 0)
 
@@ -155,7 +228,7 @@ def test_pytest_sessionfinish(api_client, tr_plugin):
          'comment': "# Pytest result: #\n    An error"}
     ]}
 
-    api_client.send_post.assert_any_call(plugin.ADD_RESULTS_URL.format(tr_plugin.testrun_id), expected_data, cert_check=True)
+    api_client.send_post.assert_any_call(URL.add_results.format(tr_plugin.testrun_id), expected_data, cert_check=True)
 
 
 def test_pytest_sessionfinish_testplan(api_client, tr_plugin):
@@ -166,7 +239,11 @@ def test_pytest_sessionfinish_testplan(api_client, tr_plugin):
     tr_plugin.testplan_id = 100
     tr_plugin.testrun_id = 0
 
-    api_client.send_get.return_value = TESTPLAN
+    api_client.send_get.side_effect = send_get_by_uri({
+        URL.get_testplan.format(100): TESTPLAN,
+        URL.get_tests.format(59): run_tests(1234, 5678),
+        URL.get_tests.format(61): run_tests(1234, 5678),
+    })
     tr_plugin.pytest_sessionfinish(None, 0)
     expected_data = {'results': [
         {'case_id': 1234, 'status_id': TESTRAIL_TEST_STATUS["passed"], 'version': '1.0.0.0', 'elapsed': '3s'},
@@ -175,12 +252,110 @@ def test_pytest_sessionfinish_testplan(api_client, tr_plugin):
     ]}
     print(api_client.send_post.call_args_list)
 
-    api_client.send_post.assert_any_call(plugin.ADD_RESULTS_URL.format(59, 1234),
+    api_client.send_post.assert_any_call(URL.add_results.format(59, 1234),
                                          expected_data, cert_check=True)
-    api_client.send_post.assert_any_call(plugin.ADD_RESULTS_URL.format(61, 5678),
+    api_client.send_post.assert_any_call(URL.add_results.format(61, 5678),
                                          expected_data, cert_check=True)
 
 
+def test_pytest_sessionfinish_testplan_partial_testruns(api_client, tr_plugin):
+    """ Each testrun of the testplan only receives results of its own testcases """
+    tr_plugin.results = [
+        {'case_id': 5678, 'status_id': TESTRAIL_TEST_STATUS["blocked"]},
+        {'case_id': 1234, 'status_id': TESTRAIL_TEST_STATUS["passed"]}
+    ]
+    tr_plugin.testplan_id = 100
+    tr_plugin.testrun_id = 0
+    api_client.send_get.side_effect = send_get_by_uri({
+        URL.get_testplan.format(100): TESTPLAN,
+        URL.get_tests.format(59): run_tests(1234),
+        URL.get_tests.format(61): run_tests(5678, 9999),
+    })
+    api_client.send_post.return_value = {}
+
+    tr_plugin.pytest_sessionfinish(None, 0)
+
+    assert api_client.send_post.call_args_list == [
+        call(URL.add_results.format(59), {'results': [
+            {'case_id': 1234, 'status_id': TESTRAIL_TEST_STATUS["passed"], 'version': '1.0.0.0'}
+        ]}, cert_check=True),
+        call(URL.add_results.format(61), {'results': [
+            {'case_id': 5678, 'status_id': TESTRAIL_TEST_STATUS["blocked"], 'version': '1.0.0.0'}
+        ]}, cert_check=True)
+    ]
+
+
+def test_publish_results_batches(api_client, tr_plugin):
+    tr_plugin.max_results_per_request = 2
+    tr_plugin.results = [
+        {'case_id': case_id, 'status_id': TESTRAIL_TEST_STATUS["passed"]} for case_id in (1, 2, 3)
+    ]
+    api_client.send_get.return_value = run_tests(1, 2, 3)
+    api_client.send_post.return_value = {}
+
+    tr_plugin.publish_results(10)
+
+    assert api_client.send_post.call_args_list == [
+        call(URL.add_results.format(10), {'results': [
+            {'case_id': 1, 'status_id': TESTRAIL_TEST_STATUS["passed"], 'version': '1.0.0.0'},
+            {'case_id': 2, 'status_id': TESTRAIL_TEST_STATUS["passed"], 'version': '1.0.0.0'}
+        ]}, cert_check=True),
+        call(URL.add_results.format(10), {'results': [
+            {'case_id': 3, 'status_id': TESTRAIL_TEST_STATUS["passed"], 'version': '1.0.0.0'}
+        ]}, cert_check=True)
+    ]
+
+
+def test_publish_results_fallback_one_by_one(api_client, tr_plugin):
+    tr_plugin.results = [
+        {'case_id': 1234, 'status_id': TESTRAIL_TEST_STATUS["passed"]},
+        {'case_id': 5678, 'status_id': TESTRAIL_TEST_STATUS["failed"]}
+    ]
+    api_client.send_get.return_value = run_tests(1234, 5678)
+    api_client.send_post.side_effect = [{'error': 'Field :results.case_id is not a valid test case.'}, {}, {}]
+
+    tr_plugin.publish_results(10)
+
+    assert api_client.send_post.call_count == 3
+    api_client.send_post.assert_any_call(
+        f'{URL.add_result}/10/1234',
+        {'case_id': 1234, 'status_id': TESTRAIL_TEST_STATUS["passed"], 'version': '1.0.0.0'}, cert_check=True)
+    api_client.send_post.assert_any_call(
+        f'{URL.add_result}/10/5678',
+        {'case_id': 5678, 'status_id': TESTRAIL_TEST_STATUS["failed"], 'version': '1.0.0.0'}, cert_check=True)
+
+
+def test_publish_results_batch_error(api_client, tr_plugin):
+    """ Errors not related to a testcase are not replayed one by one """
+    tr_plugin.results = [
+        {'case_id': 1234, 'status_id': TESTRAIL_TEST_STATUS["passed"]},
+        {'case_id': 5678, 'status_id': TESTRAIL_TEST_STATUS["failed"]}
+    ]
+    api_client.send_get.return_value = run_tests(1234, 5678)
+    api_client.send_post.return_value = {'error': 'Authentication failed: invalid or missing user/password.'}
+
+    tr_plugin.publish_results(10)
+
+    api_client.send_post.assert_called_once()
+
+
+def test_publish_results_truncated_comment(api_client, tr_plugin):
+    tr_plugin.max_comment_size = 10
+    tr_plugin.results = [
+        {'case_id': 1234, 'status_id': TESTRAIL_TEST_STATUS["failed"], 'comment': 'line 1\nline 2\nline 3'}
+    ]
+    api_client.send_get.return_value = run_tests(1234)
+    api_client.send_post.return_value = {}
+
+    tr_plugin.publish_results(10)
+
+    expected_data = {'results': [
+        {'case_id': 1234, 'status_id': TESTRAIL_TEST_STATUS["failed"], 'version': '1.0.0.0',
+         'comment': "# Pytest result: #\nLog truncated\n...\n    e 2\n    line 3"}
+    ]}
+    api_client.send_post.assert_called_once_with(URL.add_results.format(10), expected_data, cert_check=True)
+
+
 @pytest.mark.parametrize('include_all', [True, False])
 def test_create_test_run(api_client, tr_plugin, include_all):
     expected_tr_keys = [3453, 234234, 12]
@@ -188,7 +363,7 @@ def test_create_test_run(api_client, tr_plugin, include_all):
 
     tr_plugin.create_test_run(ASSIGN_USER_ID, PROJECT_ID, SUITE_ID, include_all, expect_name, expected_tr_keys)
 
-    expected_uri = plugin.ADD_TESTRUN_URL.format(PROJECT_ID)
+    expected_uri = URL.add_testrun.format(PROJECT_ID)
     expected_data = {
         'suite_id': SUITE_ID,
         'name': expect_name,
@@ -208,9 +383,11 @@ def test_is_testrun_available(api_client, tr_plugin):
     assert tr_plugin.is_testrun_available is True
 
     api_client.send_get.return_value = {'error': 'An error occurred'}
+    del tr_plugin.is_testrun_available
     assert tr_plugin.is_testrun_available is False
 
     api_client.send_get.return_value = {'is_completed': True}
+    del tr_plugin.is_testrun_available
     assert tr_plugin.is_testrun_available is False
 
 
@@ -222,12 +399,25 @@ def test_is_testplan_available(api_client, tr_plugin):
     assert tr_plugin.is_testplan_available is True
 
     api_client.send_get.return_value = {'error': 'An error occurred'}
+    del tr_plugin.is_testplan_available
+    tr_plugin._testplans.clear()
     assert tr_plugin.is_testplan_available is False
 
     api_client.send_get.return_value = {'is_completed': True}
+    del tr_plugin.is_testplan_available
+    tr_plugin._testplans.clear()
     assert tr_plugin.is_testplan_available is False
 
 
+def test_is_testrun_available_cached(api_client, tr_plugin):
+    tr_plugin.testrun_id = 100
+    api_client.send_get.return_value = {'is_completed': False}
+
+    assert tr_plugin.is_testrun_available is True
+    assert tr_plugin.is_testrun_available is True
+    api_client.send_get.assert_called_once_with(URL.get_testrun.format(100), cert_check=True)
+
+
 def test_get_available_testruns(api_client, tr_plugin):
     """ Test of method `get_available_testruns` """
     testplan_id = 100
@@ -235,6 +425,15 @@ def test_get_available_testruns(api_client, tr_plugin):
     assert tr_plugin.get_available_testruns(testplan_id) == [59, 61]
 
 
+def test_testplan_fetched_once(api_client, tr_plugin):
+    tr_plugin.testplan_id = 100
+    api_client.send_get.return_value = TESTPLAN
+
+    assert tr_plugin.is_testplan_available is True
+    assert tr_plugin.get_available_testruns(tr_plugin.testplan_id) == [59, 61]
+    api_client.send_get.assert_called_once_with(URL.get_testplan.format(100), cert_check=True)
+
+
 def test_close_test_run(api_client, tr_plugin):
     tr_plugin.results = [
         {'case_id': 1234, 'status_id': TESTRAIL_TEST_STATUS["failed"], 'duration': 2.6},
@@ -243,10 +442,55 @@ def test_close_test_run(api_client, tr_plugin):
     ]
     tr_plugin.testrun_id = 10
     tr_plugin.close_on_complete = True
+    api_client.send_get.return_value = run_tests(1234, 5678)
+    tr_plugin.pytest_sessionfinish(None, 0)
+
+    expected_uri = URL.close_testrun.format(tr_plugin.testrun_id)
+    assert len(api_client.send_post.call_args_list) == 2
+    assert api_client.send_post.call_args_list[1] == call(expected_uri, data={}, cert_check=True)
+
+
+def test_pytest_sessionfinish_tests_not_found(api_client, tr_plugin):
+    """ Results are still published when tests of the testrun can't be retrieved """
+    tr_plugin.results = [{'case_id': 1234, 'status_id': TESTRAIL_TEST_STATUS["passed"]}]
+    tr_plugin.testrun_id = 10
+    tr_plugin.close_on_complete = True
+    api_client.send_get.return_value = {'error': 'An error occurred'}
+    api_client.send_post.return_value = {}
+
+    tr_plugin.pytest_sessionfinish(None, 0)
+
+    assert api_client.send_post.call_args_list == [
+        call(URL.add_results.format(10), {'results': [
+            {'case_id': 1234, 'status_id': TESTRAIL_TEST_STATUS["passed"], 'version': '1.0.0.0'}
+        ]}, cert_check=True),
+        call(URL.close_testrun.format(10), data={}, cert_check=True)
+    ]
+    api_client.close.assert_called_once_with()
+
+
+def test_pytest_sessionfinish_closes_client(api_client, tr_plugin):
     tr_plugin.pytest_sessionfinish(None, 0)
 
-    expected_uri = plugin.CLOSE_TESTRUN_URL.format(tr_plugin.testrun_id)
-    api_client.send_post.call_args_list[1] = call(expected_uri, {}, cert_check=True)
+    api_client.close.assert_called_once_with()
+
+
+@pytest.mark.parametrize('method', ['get', 'post'])
+def test_client_uses_session(method):
+    client = APIClient('https://tr.example.com/', 'user', 'password')
+    client._session = create_autospec(requests.Session, instance=True)
+    getattr(client._session, method).return_value.status_code = 200
+    getattr(client._session, method).return_value.json.return_value = {'id': 1}
+
+    if method == 'get':
+        assert client.send_get('get_run/1') == {'id': 1}
+    else:
+        assert client.send_post('get_run/1', {}) == {'id': 1}
+    getattr(client._session, method).assert_called_once()
+    assert getattr(client._session, method).call_args[0][0] == 'https://tr.example.com/index.php?/api/v2/get_run/1'
+
+    client.close()
+    client._session.close.assert_called_once_with()
 
 
 def test_close_test_plan(api_client, tr_plugin):
@@ -258,11 +502,16 @@ def test_close_test_plan(api_client, tr_plugin):
     tr_plugin.testrun_id = 0
     tr_plugin.close_on_complete = True
 
-    api_client.send_get.return_value = TESTPLAN
+    api_client.send_get.side_effect = send_get_by_uri({
+        URL.get_testplan.format(100): TESTPLAN,
+        URL.get_tests.format(59): run_tests(1234, 5678),
+        URL.get_tests.format(61): run_tests(1234, 5678),
+    })
     tr_plugin.pytest_sessionfinish(None, 0)
 
-    expected_uri = plugin.CLOSE_TESTPLAN_URL.format(tr_plugin.testplan_id)
-    api_client.send_post.call_args_list[1] = call(expected_uri, {}, cert_check=True)
+    expected_uri = URL.close_testplan.format(tr_plugin.testplan_id)
+    assert len(api_client.send_post.call_args_list) == 3  # One batch per available testrun, then closing
+    assert api_client.send_post.call_args_list[2] == call(expected_uri, data={}, cert_check=True)
 
 
 def test_dont_publish_blocked(api_client):
@@ -285,15 +534,14 @@ def test_dont_publish_blocked(api_client):
 
     my_plugin.pytest_sessionfinish(None, 0)
 
-    api_client.send_get.assert_called_once_with(plugin.GET_TESTS_URL.format(my_plugin.testrun_id),
+    api_client.send_get.assert_called_once_with(URL.get_tests.format(my_plugin.testrun_id),
                                                 cert_check=True)
-    expected_uri = plugin.ADD_RESULTS_URL.format(my_plugin.testrun_id)
-    expected_data = {'results': [{'case_id': 1234, 'status_id': TESTRAIL_TEST_STATUS["blocked"], 'version': '1.0.0.0'}]}
-    len(api_client.send_post.call_args_list) == 1
-    api_client.send_post.call_args_list[0] == call(expected_uri, expected_data, cert_check=True)
+    expected_uri = URL.add_results.format(my_plugin.testrun_id)
+    expected_data = {'results': [{'case_id': 5678, 'status_id': TESTRAIL_TEST_STATUS["passed"], 'version': '1.0.0.0'}]}
+    assert api_client.send_post.call_args_list == [call(expected_uri, expected_data, cert_check=True)]
 
 
-def test_skip_missing_only_one_test(api_client, pytest_test_items):
+def test_skip_missing_only_one_test(api_client, pytest_test_items, monkeypatch):
     my_plugin = PyTestRailPlugin(api_client, ASSIGN_USER_ID, PROJECT_ID,
                                  SUITE_ID, False, True, TR_NAME,
                                  run_id=10,
@@ -304,7 +552,7 @@ def test_skip_missing_only_one_test(api_client, pytest_test_items):
     api_client.send_get.return_value = [
         {"case_id": 1234}, {"case_id": 5678}
     ]
-    my_plugin.is_testrun_available = lambda: True
+    monkeypatch.setattr(PyTestRailPlugin, 'is_testrun_available', True)
 
     my_plugin.pytest_collection_modifyitems(None, None, pytest_test_items)
 
@@ -312,7 +560,7 @@ def test_skip_missing_only_one_test(api_client, pytest_test_items):
     assert pytest_test_items[1].get_closest_marker('skip')
 
 
-def test_skip_missing_correlation_tests(api_client, pytest_test_items):
+def test_skip_missing_correlation_tests(api_client, pytest_test_items, monkeypatch):
     my_plugin = PyTestRailPlugin(api_client, ASSIGN_USER_ID, PROJECT_ID,
                                  SUITE_ID, False, True, TR_NAME,
                                  run_id=10,
@@ -323,7 +571,7 @@ def test_skip_missing_correlation_tests(api_client, pytest_test_items):
     api_client.send_get.return_value = [
         {"case_id": 1234}, {"case_id": 8765}
     ]
-    my_plugin.is_testrun_available = lambda: True
+    monkeypatch.setattr(PyTestRailPlugin, 'is_testrun_available', True)
 
     my_plugin.pytest_collection_modifyitems(None, None, pytest_test_items)
 